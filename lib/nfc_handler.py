@@ -3,9 +3,11 @@
 
 """ NFC tag handling """
 
-import time
+import asyncio
 import logging
-from threading import Lock, Event
+import re
+from threading import Event, Lock
+from typing import List, Optional, Tuple
 
 import ndef
 import nfc
@@ -16,6 +18,21 @@ SPOOL = "SPOOL"
 FILAMENT = "FILAMENT"
 NDEF_TEXT_TYPE = "urn:nfc:wkt:T"
 
+# The line boundaries str.splitlines() uses:
+_LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+# A whole "SPOOL:n" or "FILAMENT:n" line, without trailing whitespace:
+_TEXT_RE = re.compile(
+    rf"(?:^|(?<=[{_LINE_BREAKS}]))({SPOOL}|{FILAMENT})"
+    rf":([^:{_LINE_BREAKS}]*?)[^\S{_LINE_BREAKS}]*(?=[{_LINE_BREAKS}]|\Z)"
+)
+
+# Return the tag from connect() instead of keeping the connection:
+_RDWR_OPTIONS = {"on-connect": lambda tag: False}
+
+# Targets to sense for while waiting for the tag to be removed:
+_TARGETS = (RemoteTarget("106A"), RemoteTarget("106B"), RemoteTarget("212F"))
+
 logger = logging.getLogger(__name__)
 
 
@@ -29,10 +46,11 @@ class NfcHandler:
         self.on_nfc_no_tag_present = None
         self.on_nfc_tag_present = None
         self.should_stop_event = Event()
+        self._wake_event = Event()
         self.write_lock = Lock()
-        self.write_event = Event()
-        self.write_spool = None
-        self.write_filament = None
+        # Pending (spool, filament, on_done) write request, on_done is
+        # called with True when written, or False when replaced or failed:
+        self._pending_write = None
 
     def set_no_tag_present_callback(self, on_nfc_no_tag_present):
         """Sets a callback that will be called when no tag is present"""
@@ -43,7 +61,9 @@ class NfcHandler:
         self.on_nfc_tag_present = on_nfc_tag_present
 
     @classmethod
-    def get_data_from_ndef_records(cls, records: ndef.TextRecord):
+    def get_data_from_ndef_records(
+        cls, records: List[ndef.Record]
+    ) -> Tuple[Optional[str], Optional[str]]:
         """Find wanted data from the NDEF records.
 
         >>> import ndef
@@ -51,6 +71,12 @@ class NfcHandler:
         >>> record1 = ndef.TextRecord("SPOOL:23\\n")
         >>> record2 = ndef.TextRecord("FILAMENT:14\\n")
         >>> record3 = ndef.TextRecord("SPOOL:23\\nFILAMENT:14\\n")
+        >>> record4 = ndef.TextRecord("SPOOL:23 \\r\\nFILAMENT:14\\r\\n")
+        >>> record5 = ndef.UriRecord("https://example.com")
+        >>> record6 = ndef.TextRecord("SPOOL:23\\rFILAMENT:14\\r")
+        >>> record7 = ndef.TextRecord("SPOOL:23:4\\nFILAMENT: \\n")
+        >>> NfcHandler.get_data_from_ndef_records([])
+        (None, None)
         >>> NfcHandler.get_data_from_ndef_records([record0])
         (None, None)
         >>> NfcHandler.get_data_from_ndef_records([record3])
@@ -67,43 +93,123 @@ class NfcHandler:
         ('23', '14')
         >>> NfcHandler.get_data_from_ndef_records([record2, record1])
         ('23', '14')
+        >>> NfcHandler.get_data_from_ndef_records([record4])
+        ('23', '14')
+        >>> NfcHandler.get_data_from_ndef_records([record1, record5, record2])
+        ('23', '14')
+        >>> NfcHandler.get_data_from_ndef_records([record6])
+        ('23', '14')
+        >>> NfcHandler.get_data_from_ndef_records([record7])
+        (None, '')
         """
 
-        spool = None
-        filament = None
+        texts = []
+
+        # Look these up once, not for every record:
+        text_type = NDEF_TEXT_TYPE
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
 
         for record in records:
-            if record.type == NDEF_TEXT_TYPE:
-                for line in record.text.splitlines():
-                    line = line.split(":")
-                    if len(line) == 2:
-                        if line[0] == SPOOL:
-                            spool = line[1]
-                        if line[0] == FILAMENT:
-                            filament = line[1]
-            else:
-                logger.info("Read other record: %s", record)
-
-        return spool, filament
+            if record.type == text_type:
+                texts.append(record.text)
+            elif debug_enabled:
+                logger.debug(
+                    "Read other record type=%s name=%s", record.type, record.name
+                )
+
+        if not texts:
+            return None, None
+
+        # Scan all text records at once, later values override earlier ones:
+        values = dict(_TEXT_RE.findall("\n".join(texts)))
+
+        return values.get(SPOOL), values.get(FILAMENT)
 
     def write_to_tag(self, spool: int, filament: int) -> bool:
         """Writes spool & filament info to tag. Returns true if worked."""
 
-        self._set_write_info(spool, filament)
+        done = Event()
+        result = [False]
 
-        if self.write_event.wait(timeout=30):
-            return True
+        def on_done(written: bool):
+            result[0] = written
+            done.set()
+
+        request = (spool, filament, on_done)
+        self._queue_write(request)
 
-        self._set_write_info(None, None)
+        if done.wait(timeout=30):
+            return result[0]
 
+        self._cancel_write(request)
         return False
 
+    async def write_to_tag_async(
+        self, spool: int, filament: int, timeout: float = 30
+    ) -> bool:
+        """Like write_to_tag, but waits without blocking a thread.
+        Returns true if worked.
+
+        >>> import asyncio
+        >>> handler = NfcHandler("usb")
+        >>> asyncio.run(handler.write_to_tag_async(1, 2, timeout=0.01))
+        False
+        >>> async def write_twice():
+        ...     first = asyncio.create_task(handler.write_to_tag_async(1, 2))
+        ...     await asyncio.sleep(0)
+        ...     second = handler.write_to_tag_async(3, 4, timeout=0.01)
+        ...     return await second, await first
+        >>> asyncio.run(write_twice())
+        (False, False)
+        >>> async def write_and_cancel():
+        ...     task = asyncio.create_task(handler.write_to_tag_async(1, 2))
+        ...     await asyncio.sleep(0)
+        ...     task.cancel()
+        ...     await asyncio.wait([task])
+        ...     return task.cancelled()
+        >>> asyncio.run(write_and_cancel())
+        True
+        >>> from types import SimpleNamespace
+        >>> tag = SimpleNamespace(ndef=SimpleNamespace(octets=b"", is_writeable=True))
+        >>> handler._check_for_write_to_tag(tag)
+        False
+        >>> tag.ndef.octets
+        b''
+        """
+
+        loop = asyncio.get_running_loop()
+        written = loop.create_future()
+
+        def set_written(result: bool):
+            if not written.done():
+                written.set_result(result)
+
+        def on_done(result: bool):
+            try:
+                loop.call_soon_threadsafe(set_written, result)
+            except RuntimeError:
+                # The event loop has been closed
+                pass
+
+        request = (spool, filament, on_done)
+        self._queue_write(request)
+
+        try:
+            return await asyncio.wait_for(written, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            # Also when cancelled, don't write the tag later:
+            self._cancel_write(request)
+
     def run(self):
         """Run the NFC handler, won't return"""
         # Open NFC reader. Will throw an exception if it fails.
         with nfc.ContactlessFrontend(self.nfc_device) as clf:
             while not self.should_stop_event.is_set():
-                tag = clf.connect(rdwr={"on-connect": lambda tag: False})
+                tag = clf.connect(
+                    rdwr=_RDWR_OPTIONS, terminate=self.should_stop_event.is_set
+                )
                 if tag:
                     self._check_for_write_to_tag(tag)
                     if tag.ndef is None:
@@ -112,27 +218,50 @@ class NfcHandler:
                     else:
                         self._read_from_tag(tag)
 
-                    # Wait for the tag to be removed.
-                    while clf.sense(
-                        RemoteTarget("106A"), RemoteTarget("106B"), RemoteTarget("212F")
-                    ):
+                    # Wait for the tag to be removed, or the handler stopped.
+                    while not self.should_stop_event.is_set() and clf.sense(*_TARGETS):
                         if self._check_for_write_to_tag(tag):
                             self._read_from_tag(tag)
-                        time.sleep(0.2)
+                        self._wait_for_wake()
                 else:
-                    time.sleep(0.2)
+                    self._wait_for_wake()
 
     def stop(self):
         """Call to stop the handler"""
         self.should_stop_event.set()
+        self._wake_event.set()
 
     def _write_to_nfc_tag(self, tag, spool: int, filament: int) -> bool:
-        """Write given spool/filament ids to the tag"""
+        """Write given spool/filament ids to the tag
+
+        >>> from types import SimpleNamespace
+        >>> class FakeNdef:  # Decodes records like nfcpy does
+        ...     octets = b"\\xd1\\x01\\x05T"  # Truncated, undecodable
+        ...     is_writeable = True
+        ...     @property
+        ...     def records(self):
+        ...         return list(ndef.message_decoder(self.octets, errors="relax"))
+        >>> handler = NfcHandler("usb")
+        >>> tag = SimpleNamespace(ndef=FakeNdef())
+        >>> handler._write_to_nfc_tag(tag, 23, 14)
+        True
+        >>> NfcHandler.get_data_from_ndef_records(tag.ndef.records)
+        ('23', '14')
+        >>> tag.ndef.is_writeable = False
+        >>> handler._write_to_nfc_tag(tag, 23, 14)
+        True
+        >>> handler._write_to_nfc_tag(tag, 23, 15)
+        False
+        """
+        records = [ndef.TextRecord(f"{SPOOL}:{spool}\n{FILAMENT}:{filament}\n")]
+        # Compare the raw data, the tag's current data might not decode:
+        octets = b"".join(ndef.message_encoder(records))
         try:
+            if tag.ndef and tag.ndef.octets == octets:
+                logger.info("Tag already has the same data, not writing it")
+                return True
             if tag.ndef and tag.ndef.is_writeable:
-                tag.ndef.records = [
-                    ndef.TextRecord(f"{SPOOL}:{spool}\n{FILAMENT}:{filament}\n")
-                ]
+                tag.ndef.octets = octets
                 return True
             self.status = "Tag is write protected"
         except Exception as ex:  # pylint: disable=W0718
@@ -140,25 +269,40 @@ class NfcHandler:
             self.status = "Got error while writing"
         return False
 
-    def _set_write_info(self, spool, filament):
-        if self.write_lock.acquire():  # pylint: disable=R1732
-            self.write_spool = spool
-            self.write_filament = filament
-            self.write_event.clear()
-            self.write_lock.release()
+    def _queue_write(self, request):
+        """Hand a write request to the NFC thread, replacing any pending one"""
+        with self.write_lock:
+            replaced = self._pending_write
+            self._pending_write = request
+        if replaced:
+            logger.info("Replacing pending write of spool %s", replaced[0])
+            replaced[2](False)
+        self._wake_event.set()
+
+    def _cancel_write(self, request):
+        """Remove a write request, if it is still pending"""
+        with self.write_lock:
+            if self._pending_write is request:
+                self._pending_write = None
+
+    def _wait_for_wake(self):
+        """Sleep up to 0.2s, or until woken by a write request or stop"""
+        if self._wake_event.wait(0.2):
+            self._wake_event.clear()
 
     def _check_for_write_to_tag(self, tag) -> bool:
         """Check if the tag should be written to and do it"""
-        did_write = False
-        if self.write_lock.acquire():  # pylint: disable=R1732
-            if self.write_spool:
-                if self._write_to_nfc_tag(tag, self.write_spool, self.write_filament):
-                    self.write_event.set()
-                    did_write = True
-                self.write_spool = None
-                self.write_filament = None
-            self.write_lock.release()
-        return did_write
+        with self.write_lock:
+            request = self._pending_write
+            self._pending_write = None
+        if not request:
+            return False
+        spool, filament, on_done = request
+        if self._write_to_nfc_tag(tag, spool, filament):
+            on_done(True)
+            return True
+        on_done(False)
+        return False
 
     def _read_from_tag(self, tag):
         """Read data from tag and call callback"""